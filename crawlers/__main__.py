@@ -0,0 +1,42 @@
+"""
+Run all crawlers concurrently on a single shared AsyncWebCrawler.
+
+Usage: python -m crawlers
+"""
+import asyncio
+import sys
+
+from crawl4ai import AsyncWebCrawler
+
+from crawlers import idealo, kleineskraftwerk, priwatt
+
+try:
+    import uvloop
+except ImportError:  # Optional speedup; not available on Windows
+    uvloop = None
+
+SITES = (idealo, kleineskraftwerk, priwatt)
+
+
+async def main() -> int:
+    """Main function."""
+    async with AsyncWebCrawler(concurrency=8) as crawler:
+        results = await asyncio.gather(
+            *[site.run(crawler) for site in SITES],
+            return_exceptions=True,
+        )
+
+    failed = 0
+    for site, result in zip(SITES, results):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"[错误] 运行 '{site.__name__}' 时发生意外错误：{result}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    run = uvloop.run if uvloop is not None else asyncio.run
+    try:
+        sys.exit(run(main()))
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -2,20 +2,28 @@
 Crawler for idealo.de - Price comparison portal.
 """
 import asyncio
+import codecs
 import csv
+import functools
+import io
 import os
 import re
 from pathlib import Path
 from urllib.parse import urlparse, parse_qs, urlsplit, unquote, urljoin
 
 from crawl4ai import AsyncWebCrawler
-from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
 
 # Configuration
 SEARCH_QUERY = "anker solix"
 BASE_URL = "https://www.idealo.de/preisvergleich/MainSearchProductCategory.html"
 IDEALO_ORIGIN = "https://www.idealo.de"
 
+# Maximum number of detail pages fetched at the same time
+DETAIL_CONCURRENCY = max(1, int(os.environ.get("ASH_SPIDER_DETAIL_CONCURRENCY", "8")))
+
 HEADERS = {
     "User-Agent": (
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
@@ -35,12 +43,79 @@ JS_WAIT = """
 # Set output path to data folder (parent directory)
 OUTPUT_DIR = Path(__file__).resolve().parent.parent / "data"
 OUTPUT_PATH = OUTPUT_DIR / "idealo.csv"
+# Write buffer for the output CSV; rows are flushed in large blocks
+CSV_BUFFER_SIZE = 1 << 20
+
+# Precompiled patterns
+_PRICE_RE = re.compile(r"\b(?:ab|ao)\s*([\d\.\,]+)\s*€", re.IGNORECASE)
+_CLEAN_PRICE_RE = re.compile(r"(?:^\s*(?:ab|ao)\s*|\b(?:ab|ao)\b\s*)", re.IGNORECASE)
+_HOST_RE = re.compile(r"[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+
+# Merchant name cleanup
+_UNWANTED_SUFFIXES = frozenset({
+    "de", "com", "net", "org", "eu", "uk", "us", "ca", "au",
+    "media", "shop", "store", "market", "mall", "direct", "direkt",
+    "online", "web", "site", "portal", "center", "group", "corp",
+    "inc", "ltd", "gmbh", "ag", "kg", "co", "llc",
+})
+_SEPARATORS = (".", "-", "_", " ")
+_SEP_TABLE = str.maketrans("", "", "".join(_SEPARATORS))
+
+# Shared HTML parser, reused for every page parsed in this process
+_HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8", remove_blank_text=True, recover=True)
+
+# Precompiled selectors (compiled to XPath once at import)
+_SEARCH_ANCHORS = CSSSelector('a[href*="/preisvergleich/OffersOfProduct/"]', translator="html")
+# Ordered from most to least specific; the first selector that matches wins
+_OFFER_CONTAINERS = tuple(
+    CSSSelector(css, translator="html")
+    for css in (
+        "#offerList",
+        "div[data-test='productOffers']",
+        "section[data-test='offers']",
+        "div.productOffers",
+        "div[id*='productOffers']",
+    )
+)
+_OFFER_ITEMS = tuple(
+    CSSSelector(css, translator="html")
+    for css in ("li.productOffers-listItem", "div.productOffers-listItem")
+)
+# Most specific first: a[data-shop-name] also matches logo and title anchors
+# that come before the leadout button, so these must not be merged into a union.
+_CTA_ANCHORS = tuple(
+    CSSSelector(css, translator="html")
+    for css in (
+        "a.productOffers-listItemOfferCtaLeadout.button.button--leadout[data-shop-name]",
+        "a.button--leadout[data-shop-name]",
+        "a[data-shop-name]",
+        "a.button--leadout",
+    )
+)
+_HREF_ANCHORS = CSSSelector("a[href]", translator="html")
+_PRICE_ELEMENTS = tuple(
+    CSSSelector(css, translator="html")
+    for css in (
+        "div.productOffers-listItemOfferPrice",
+        "div.productOffers-listItemPrice",
+        "a.productOffers-listItemOfferPrice",
+        "span.price",
+    )
+)
+_SHOP_LOGOS = tuple(
+    CSSSelector(css, translator="html")
+    for css in (
+        "img.productOffers-listItemOfferShopV2LogoImage[alt]",
+        "img[alt][class*='Logo'], img[alt][class*='Shop']",
+    )
+)
 
 # ============================================================================
 # Utility Functions
 # ============================================================================
 
 
+@functools.lru_cache(maxsize=4096)
 def to_absolute(url: str) -> str:
     """Convert relative URLs to absolute URLs."""
     if not url:
@@ -50,6 +125,7 @@ def to_absolute(url: str) -> str:
     return urljoin(IDEALO_ORIGIN, url)
 
 
+@functools.lru_cache(maxsize=4096)
 def resolve_idealo_redirect(url: str) -> str:
     """Resolve idealo redirect URLs to get the real target URL."""
     try:
@@ -68,14 +144,18 @@ def resolve_idealo_redirect(url: str) -> str:
         return url
 
 
+def normalize_host(host: str) -> str:
+    """Lowercase a host or shop name and drop a leading 'www.'."""
+    host = host.lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+@functools.lru_cache(maxsize=4096)
 def extract_host(url: str) -> str:
     """Extract hostname from URL."""
     if not url:
         return ""
-    host = (urlparse(url).hostname or "").lower()
-    if host.startswith("www."):
-        host = host[4:]
-    return host
+    return normalize_host(urlparse(url).hostname or "")
 
 
 def extract_merchant_from_alt(alt_text: str) -> str:
@@ -83,20 +163,17 @@ def extract_merchant_from_alt(alt_text: str) -> str:
     if not alt_text:
         return ""
     merchant = alt_text.split(" - ", 1)[0].strip()
-    m = re.search(r"[A-Za-z0-9.-]+\.[A-Za-z]{2,}", merchant)
+    m = _HOST_RE.search(merchant)
     if m:
         merchant = m.group(0)
-    merchant = merchant.lower()
-    if merchant.startswith("www."):
-        merchant = merchant[4:]
-    return merchant
+    return normalize_host(merchant)
 
 
 def parse_price_from_text(txt: str) -> str:
     """Extract price from text."""
     if not txt:
         return ""
-    m = re.search(r"\b(?:ab|ao)\s*([\d\.\,]+)\s*€", txt, flags=re.IGNORECASE)
+    m = _PRICE_RE.search(txt)
     if m:
         return f"{m.group(1)} €"
     return ""
@@ -106,9 +183,7 @@ def clean_price(txt: str) -> str:
     """Clean price text by removing prefixes and extra characters."""
     if not txt:
         return ""
-    txt = re.sub(r"^\s*(ab|ao)\s*", "", txt, flags=re.IGNORECASE)
-    txt = re.sub(r"\b(ab|ao)\b\s*", "", txt, flags=re.IGNORECASE)
-    return txt.strip()
+    return _CLEAN_PRICE_RE.sub("", txt).strip()
 
 
 def clean_merchant_name(merchant: str) -> str:
@@ -116,29 +191,22 @@ def clean_merchant_name(merchant: str) -> str:
     if not merchant:
         return ""
 
-    merchant = merchant.lower().strip()
-    if merchant.startswith("www."):
-        merchant = merchant[4:]
+    merchant = normalize_host(merchant.strip())
 
-    unwanted_suffixes = [
-        "de", "com", "net", "org", "eu", "uk", "us", "ca", "au",
-        "media", "shop", "store", "market", "mall", "direct", "direkt",
-        "online", "web", "site", "portal", "center", "group", "corp",
-        "inc", "ltd", "gmbh", "ag", "kg", "co", "llc",
-    ]
+    # Most data-shop-name values are a single bare word
+    if merchant.translate(_SEP_TABLE) == merchant:
+        return merchant if merchant not in _UNWANTED_SUFFIXES else ""
 
-    separators = ['.', '-', '_', ' ']
-    for sep in separators:
+    for sep in _SEPARATORS:
         if sep in merchant:
-            parts = merchant.split(sep)
             cleaned_parts = [
-                p.strip() for p in parts
-                if p.strip() and p.strip() not in unwanted_suffixes
+                p for p in (part.strip() for part in merchant.split(sep))
+                if p and p not in _UNWANTED_SUFFIXES
             ]
             if cleaned_parts:
                 return cleaned_parts[0]
 
-    if merchant not in unwanted_suffixes:
+    if merchant not in _UNWANTED_SUFFIXES:
         return merchant
     return ""
 
@@ -148,106 +216,116 @@ def clean_merchant_name(merchant: str) -> str:
 # ============================================================================
 
 
+def parse_html(html: str):
+    """Parse raw HTML into an lxml element tree; empty or unparseable pages yield an empty <html>."""
+    if not html or html.isspace():
+        return lxml_html.Element("html")
+    try:
+        try:
+            return lxml_html.fromstring(html, parser=_HTML_PARSER)
+        except ValueError:
+            # lxml refuses str input that carries an XML encoding declaration;
+            # the shared parser decodes UTF-8, so hand it the encoded bytes.
+            return lxml_html.fromstring(html.encode("utf-8"), parser=_HTML_PARSER)
+    except etree.ParserError:
+        # e.g. comment-only documents
+        return lxml_html.Element("html")
+
+
+def select_first(selectors, scope):
+    """Return the first match of the first selector that matches anything."""
+    for selector in selectors:
+        found = selector(scope)
+        if found:
+            return found[0]
+    return None
+
+
+def element_text(el) -> str:
+    """Return the element's text nodes joined by single spaces, like get_text(" ", strip=True)."""
+    return " ".join(" ".join(el.itertext()).split())
+
+
 def parse_search_html(html: str) -> list[dict]:
     """Parse search results from idealo."""
-    soup = BeautifulSoup(html, "lxml")
-    products = []
-    
-    for a in soup.select('a[href*="/preisvergleich/OffersOfProduct/"]'):
-        title = a.get_text(" ", strip=True)
-        if not title or len(title) < 6:
-            continue
+    doc = parse_html(html)
+    dedup: dict[str, dict] = {}
+
+    for a in _SEARCH_ANCHORS(doc):
         href = a.get("href", "")
         if not href:
             continue
         link = href if href.startswith("http") else f"{IDEALO_ORIGIN}{href}"
+        if link in dedup:
+            continue
+
+        title = element_text(a)
+        if not title or len(title) < 6:
+            continue
 
-        block_text = " ".join(a.get_text(" ", strip=True).split())
-        price_from = parse_price_from_text(block_text)
-        if not price_from and a.parent:
-            parent_text = " ".join(a.parent.get_text(" ", strip=True).split())
-            price_from = parse_price_from_text(parent_text)
+        price_from = parse_price_from_text(title)
+        parent = a.getparent()
+        if not price_from and parent is not None:
+            price_from = parse_price_from_text(element_text(parent))
 
-        products.append({
+        dedup[link] = {
             "name": title,
             "link": link,
             "price_from": price_from,
-        })
+        }
 
-    dedup = {}
-    for p in products:
-        dedup.setdefault(p["link"], p)
     return list(dedup.values())
 
 
-def find_first_offer_container(soup: BeautifulSoup):
+def find_first_offer_container(doc):
     """Find the container with product offers."""
-    return (
-        soup.select_one("#offerList")
-        or soup.select_one("div[data-test='productOffers']")
-        or soup.select_one("section[data-test='offers']")
-        or soup.select_one("div.productOffers")
-        or soup.select_one("div[id*='productOffers']")
-        or soup
-    )
+    container = select_first(_OFFER_CONTAINERS, doc)
+    return container if container is not None else doc
 
 
-def find_first_offer_item(container: BeautifulSoup):
+def find_first_offer_item(container):
     """Find the first offer item in the container."""
-    return (
-        container.select_one("li.productOffers-listItem")
-        or container.select_one("div.productOffers-listItem")
-        or None
-    )
+    return select_first(_OFFER_ITEMS, container)
 
 
-def pick_cta_anchor(scope: BeautifulSoup):
+def pick_cta_anchor(scope):
     """Pick a CTA anchor for the offer."""
-    return (
-        scope.select_one(
-            "a.productOffers-listItemOfferCtaLeadout.button.button--leadout[data-shop-name]"
-        )
-        or scope.select_one("a.button--leadout[data-shop-name]")
-        or scope.select_one("a[data-shop-name]")
-        or scope.select_one("a.button--leadout")
-    )
+    return select_first(_CTA_ANCHORS, scope)
 
 
-def find_first_offer_url(scope: BeautifulSoup) -> str:
-    """Find the URL of the first offer."""
-    cta = pick_cta_anchor(scope)
-    if cta and cta.get("href"):
-        return to_absolute(resolve_idealo_redirect(cta.get("href")))
-    candidates = scope.select("a[href]")
-    for a in candidates:
-        href = a.get("href", "")
-        if href:
-            return to_absolute(resolve_idealo_redirect(href))
-    return ""
+def find_first_offer_url(scope, cta=None) -> tuple[str, str]:
+    """Find the resolved URL of the first offer and its hostname."""
+    if cta is None:
+        cta = pick_cta_anchor(scope)
+    href = cta.get("href") if cta is not None else None
+    if not href:
+        href = next((a.get("href") for a in _HREF_ANCHORS(scope) if a.get("href")), "")
+    if not href:
+        return "", ""
+    resolved = resolve_idealo_redirect(to_absolute(href))
+    return resolved, extract_host(resolved)
 
 
 def parse_detail_html(html: str, product: dict) -> dict:
     """Parse product detail page."""
-    soup = BeautifulSoup(html, "lxml")
+    doc = parse_html(html)
 
     # Price & Shipping
-    pv_el = (
-        soup.select_one("div.productOffers-listItemOfferPrice")
-        or soup.select_one("div.productOffers-listItemPrice")
-        or soup.select_one("a.productOffers-listItemOfferPrice")
-        or soup.select_one("span.price")
-    )
-    preis_versand = pv_el.get_text(" ", strip=True) if pv_el else ""
+    pv_el = select_first(_PRICE_ELEMENTS, doc)
+    preis_versand = element_text(pv_el) if pv_el is not None else ""
     if not preis_versand:
         preis_versand = product.get("price_from", "")
     product["preis_versand"] = clean_price(preis_versand)
 
     # Find first offer
-    offers_container = find_first_offer_container(soup)
-    first_item = find_first_offer_item(offers_container) or offers_container
+    offers_container = find_first_offer_container(doc)
+    first_item = find_first_offer_item(offers_container)
+    if first_item is None:
+        first_item = offers_container
 
     # Get external link
-    first_offer_url = find_first_offer_url(first_item)
+    cta = pick_cta_anchor(first_item)
+    first_offer_url, first_offer_host = find_first_offer_url(first_item, cta)
     product["first_offer_url"] = first_offer_url
 
     # Merchant parsing priority:
@@ -256,34 +334,25 @@ def parse_detail_html(html: str, product: dict) -> dict:
     # 3) Real redirect target hostname (must not be idealo domain)
     merchant = ""
 
-    cta = pick_cta_anchor(first_item)
-    if cta:
-        ds = (cta.get("data-shop-name") or "").strip().lower()
-        if ds.startswith("www."):
-            ds = ds[4:]
-        merchant = clean_merchant_name(ds)
+    if cta is not None:
+        # clean_merchant_name normalizes case and the www. prefix itself
+        merchant = clean_merchant_name(cta.get("data-shop-name") or "")
 
     if not merchant:
-        logo_img = (
-            first_item.select_one("img.productOffers-listItemOfferShopV2LogoImage[alt]")
-            or first_item.select_one("img[alt][class*='Logo'], img[alt][class*='Shop']")
-        )
-        if logo_img:
+        logo_img = select_first(_SHOP_LOGOS, first_item)
+        if logo_img is not None:
             merchant = clean_merchant_name(
                 extract_merchant_from_alt(logo_img.get("alt", ""))
             )
 
-    if not merchant and first_offer_url:
-        # Try to parse the real redirect target
-        resolved = resolve_idealo_redirect(first_offer_url)
-        host = extract_host(resolved)
-        if (
-            host
-            and not host.endswith("idealo.de")
-            and not host.endswith("idealo.co.uk")
-            and "idealo." not in host
-        ):
-            merchant = clean_merchant_name(host)
+    if (
+        not merchant
+        and first_offer_host
+        and not first_offer_host.endswith("idealo.de")
+        and not first_offer_host.endswith("idealo.co.uk")
+        and "idealo." not in first_offer_host
+    ):
+        merchant = clean_merchant_name(first_offer_host)
 
     product["merchant"] = merchant
     product.pop("price_from", None)
@@ -295,60 +364,100 @@ def parse_detail_html(html: str, product: dict) -> dict:
 # ============================================================================
 
 
+def open_output_csv() -> io.TextIOWrapper:
+    """Open OUTPUT_PATH for CSV writing, starting with a UTF-8 BOM for Excel."""
+    raw = OUTPUT_PATH.open("wb", buffering=CSV_BUFFER_SIZE)
+    raw.write(codecs.BOM_UTF8)
+    return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+
+
 async def fetch_detail(crawler, prod: dict) -> dict:
     """Fetch product detail page."""
-    res = await crawler.arun(
-        url=prod["link"],
-        headers=HEADERS,
-        timeout=90,
-        wait_until="networkidle",
-        js_code=JS_WAIT,
-    )
-    return parse_detail_html(res.html, prod)
+    try:
+        res = await crawler.arun(
+            url=prod["link"],
+            headers=HEADERS,
+            timeout=90,
+            wait_until="networkidle",
+            js_code=JS_WAIT,
+        )
+    except Exception as exc:
+        # One failed page should not abort the run; its row keeps the search-page data
+        print(f"[idealo] 获取详情页 {prod['link']} 失败：{exc}")
+        return parse_detail_html("", prod)
+    return parse_detail_html(res.html if res else "", prod)
 
 
-async def crawl() -> list[dict]:
-    """Main crawling function for idealo."""
-    async with AsyncWebCrawler(concurrency=2) as crawler:
-        url = f"{BASE_URL}?q={SEARCH_QUERY.replace(' ', '%20')}&page=1"
-        
-        products = []
-        for attempt in range(2):  # Try up to 2 times
-            res = await crawler.arun(
-                url=url,
-                headers=HEADERS,
-                timeout=90,
-                wait_until="networkidle",
-                js_code=JS_WAIT,
-            )
-            products = parse_search_html(res.html)
-            if products:
-                print(f"[idealo] 第{attempt + 1}次解析成功，解析到 {len(products)} 个产品。")
-                break
-            else:
-                print(f"[idealo] 第{attempt + 1}次解析失败，正在重试...")
-                await asyncio.sleep(2) # Wait a bit before retrying
-
-        if not products:
-            print("[idealo] 多次尝试后未解析到任何产品。")
-            return []
-
-        detailed = await asyncio.gather(
-            *[fetch_detail(crawler, prod) for prod in products]
+async def run(crawler: AsyncWebCrawler) -> int:
+    """Crawl idealo with an externally managed crawler; returns the number of saved records."""
+    sem = asyncio.Semaphore(DETAIL_CONCURRENCY)
+
+    async def fetch_detail_bounded(crawler, prod: dict) -> dict:
+        async with sem:
+            return await fetch_detail(crawler, prod)
+
+    url = f"{BASE_URL}?q={SEARCH_QUERY.replace(' ', '%20')}&page=1"
+    
+    products = []
+    for attempt in range(2):  # Try up to 2 times
+        res = await crawler.arun(
+            url=url,
+            headers=HEADERS,
+            timeout=90,
+            wait_until="networkidle",
+            js_code=JS_WAIT,
         )
+        products = parse_search_html(res.html)
+        if products:
+            print(f"[idealo] 第{attempt + 1}次解析成功，解析到 {len(products)} 个产品。")
+            break
+        else:
+            print(f"[idealo] 第{attempt + 1}次解析失败，正在重试...")
+            await asyncio.sleep(2) # Wait a bit before retrying
+
+    if not products:
+        print("[idealo] 多次尝试后未解析到任何产品。")
+        return 0
 
     # Ensure output directory exists
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+    # Write each row as soon as its detail page is parsed
     fields = ["name", "link", "preis_versand", "first_offer_url", "merchant"]
-    with open(OUTPUT_PATH, "w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=fields)
-        writer.writeheader()
-        for item in detailed:
-            writer.writerow({k: item.get(k, "") for k in fields})
-    print(f"[idealo] 已将 {len(detailed)} 条记录保存到 {OUTPUT_PATH}")
-    
-    return detailed
+    saved = 0
+    with open_output_csv() as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        tasks = [asyncio.create_task(fetch_detail_bounded(crawler, prod)) for prod in products]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                item = await fut
+                writer.writerow((
+                    item.get("name", ""),
+                    item.get("link", ""),
+                    item.get("preis_versand", ""),
+                    item.get("first_offer_url", ""),
+                    item.get("merchant", ""),
+                ))
+                saved += 1
+        finally:
+            # If a detail task failed, stop the rest before the CSV is closed
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(f"[idealo] 已将 {saved} 条记录保存到 {OUTPUT_PATH}")
+
+    return saved
+
+
+async def crawl(crawler: AsyncWebCrawler | None = None) -> int:
+    """Main crawling function for idealo; opens its own crawler unless one is given."""
+    if crawler is not None:
+        return await run(crawler)
+    async with AsyncWebCrawler(concurrency=2) as crawler:
+        return await run(crawler)
 
 
 async def main():
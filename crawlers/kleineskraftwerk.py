@@ -2,14 +2,20 @@
 Crawler for kleineskraftwerk.de - Small power station products.
 """
 import asyncio
+import codecs
 import csv
+import io
+import os
 import re
-from decimal import Decimal, InvalidOperation
+import sys
+from dataclasses import dataclass
 from pathlib import Path
 from urllib.parse import urljoin
 
-from bs4 import BeautifulSoup
 from crawl4ai import AsyncWebCrawler
+from lxml import etree
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
 
 # Configuration
 URLS = [
@@ -21,6 +27,9 @@ URLS = [
     "https://kleineskraftwerk.de/collections/balkonkraftwerk-garten",
 ]
 
+# Maximum number of detail pages fetched at the same time
+DETAIL_CONCURRENCY = max(1, int(os.environ.get("ASH_SPIDER_DETAIL_CONCURRENCY", "8")))
+
 HEADERS = {
     "User-Agent": (
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
@@ -33,34 +42,92 @@ HEADERS = {
 # Set output path to data folder (parent directory)
 OUTPUT_DIR = Path(__file__).resolve().parent.parent / "data"
 OUTPUT_PATH = OUTPUT_DIR / "kleineskraftwerk.csv"
+# Write buffer for the output CSV; rows are flushed in large blocks
+CSV_BUFFER_SIZE = 1 << 20
+# CSV columns, in output order
+FIELDS = (
+    "source_url",
+    "title",
+    "detail_url",
+    "original_price",
+    "discount_price",
+    "discount_rate",
+)
+
+# Precompiled patterns
+_PRICE_EU_RE = re.compile(r"(\d+[\d\.]*,\d{2})")
+_DIGITS_RE = re.compile(r"\d+")
+
+# Shared HTML parser, reused for every page parsed in this process
+_HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8", remove_blank_text=True, recover=True)
+
+# Precompiled selectors (compiled to XPath once at import)
+_PRODUCT_WRAPPERS = CSSSelector("div.text-wrapper", translator="html")
+_PRODUCT_TITLE_LINK = CSSSelector(".product-title a", translator="html")
+_PRICE_BLOCKS = (
+    CSSSelector("div.product-price-wrapper span.price", translator="html"),
+    CSSSelector("span.price", translator="html"),
+)
+_DEL_AMOUNT = CSSSelector("del span.amount", translator="html")
+_INS_AMOUNT = CSSSelector("ins span.amount", translator="html")
+_AMOUNTS = CSSSelector("span.amount", translator="html")
+
+
+@dataclass(slots=True)
+class Product:
+    """One product row; fields are in FIELDS order."""
+
+    source_url: str
+    title: str
+    detail_url: str
+    original_price: str = ""
+    discount_price: str = ""
+    discount_rate: str = ""
+
+
+def parse_html(html: str):
+    """Parse raw HTML into an lxml element tree; empty or unparseable pages yield an empty <html>."""
+    if not html or html.isspace():
+        return lxml_html.Element("html")
+    try:
+        try:
+            return lxml_html.fromstring(html, parser=_HTML_PARSER)
+        except ValueError:
+            # lxml refuses str input that carries an XML encoding declaration;
+            # the shared parser decodes UTF-8, so hand it the encoded bytes.
+            return lxml_html.fromstring(html.encode("utf-8"), parser=_HTML_PARSER)
+    except etree.ParserError:
+        # e.g. comment-only documents
+        return lxml_html.Element("html")
+
 
-def parse_products(html: str, base_url: str) -> list[dict]:
+def stripped_text(el) -> str:
+    """Return the element's text nodes stripped and concatenated, like get_text(strip=True)."""
+    return "".join(t.strip() for t in el.itertext())
+
+
+def parse_products(html: str, base_url: str) -> list[Product]:
     """Parse product listings from HTML."""
     if not html:
         return []
 
-    soup = BeautifulSoup(html, "lxml")
-    products: list[dict] = []
-    
-    for wrapper in soup.select("div.text-wrapper"):
-        title_el = wrapper.select_one(".product-title a")
-        if not title_el:
+    doc = parse_html(html)
+    products: list[Product] = []
+
+    for wrapper in _PRODUCT_WRAPPERS(doc):
+        title_links = _PRODUCT_TITLE_LINK(wrapper)
+        if not title_links:
             continue
 
-        title = title_el.get_text(strip=True)
+        title_el = title_links[0]
+        title = stripped_text(title_el)
         href = title_el.get("href") or ""
-        detail_url = urljoin(base_url, href)
+        detail_url = href if href.startswith(("http://", "https://")) else urljoin(base_url, href)
         
         if not title:
             continue
 
-        products.append({
-            "title": title,
-            "detail_url": detail_url,
-            "original_price": "",
-            "discount_price": "",
-            "discount_rate": "",
-        })
+        products.append(Product(base_url, title, detail_url))
 
     return products
 
@@ -68,22 +135,24 @@ def parse_products(html: str, base_url: str) -> list[dict]:
 def clean_price_text(price: str) -> str:
     if not price:
         return ""
-    price = re.sub(r"^\s*ab\s*", "", price, flags=re.IGNORECASE)
+    price = price.lstrip()
+    if price[:2].lower() == "ab":
+        price = price[2:]
     price = price.replace("€", "").strip()
-    match = re.search(r"(\d+[\d\.]*,\d{2})", price)
+    match = _PRICE_EU_RE.search(price)
     if match:
         numeric = match.group(1)
         normalized = numeric.replace(".", "").replace(",", ".")
         try:
-            return f"{Decimal(normalized).quantize(Decimal('0.01'))}"
-        except InvalidOperation:
+            return f"{float(normalized):.2f}"
+        except ValueError:
             return normalized
-    match = re.search(r"\d+", price)
+    match = _DIGITS_RE.search(price)
     if match:
         digits = match.group(0)
         try:
-            return f"{Decimal(digits).quantize(Decimal('0.01'))}"
-        except InvalidOperation:
+            return f"{float(digits):.2f}"
+        except ValueError:
             return digits
     return price
 
@@ -111,33 +180,34 @@ def extract_prices_from_detail(html: str) -> tuple[str, str]:
     if not html:
         return "", ""
 
-    soup = BeautifulSoup(html, "lxml")
-    price_block = (
-        soup.select_one("div.product-price-wrapper span.price")
-        or soup.select_one("span.price")
-    )
+    doc = parse_html(html)
+    price_block = None
+    for selector in _PRICE_BLOCKS:
+        found = selector(doc)
+        if found:
+            price_block = found[0]
+            break
 
     original_price = ""
     discount_price = ""
 
-    if price_block:
-        del_el = price_block.select_one("del span.amount")
-        ins_el = price_block.select_one("ins span.amount")
+    if price_block is not None:
+        del_els = _DEL_AMOUNT(price_block)
+        ins_els = _INS_AMOUNT(price_block)
+        amount_els = _AMOUNTS(price_block)
 
-        if del_el:
-            original_price = clean_price_text(del_el.get_text(strip=True))
-        if ins_el:
-            discount_price = clean_price_text(ins_el.get_text(strip=True))
+        if del_els:
+            original_price = clean_price_text(stripped_text(del_els[0]))
+        if ins_els:
+            discount_price = clean_price_text(stripped_text(ins_els[0]))
 
-        if not discount_price:
-            first_amount = price_block.select_one("span.amount")
-            if first_amount:
-                discount_price = clean_price_text(first_amount.get_text(strip=True))
+        if not discount_price and amount_els:
+            discount_price = clean_price_text(stripped_text(amount_els[0]))
 
         if not original_price:
             amounts: list[str] = []
-            for span in price_block.select("span.amount"):
-                cleaned = clean_price_text(span.get_text(strip=True))
+            for span in amount_els:
+                cleaned = clean_price_text(stripped_text(span))
                 if cleaned:
                     amounts.append(cleaned)
             if len(amounts) >= 2:
@@ -150,7 +220,7 @@ def extract_prices_from_detail(html: str) -> tuple[str, str]:
     return original_price, discount_price
 
 
-async def fetch_products(crawler: AsyncWebCrawler, url: str) -> list[dict]:
+async def fetch_products(crawler: AsyncWebCrawler, url: str) -> list[Product]:
     print(f"🔍 正在爬取 {url} ...")
     try:
         res = await crawler.arun(
@@ -173,8 +243,8 @@ async def fetch_products(crawler: AsyncWebCrawler, url: str) -> list[dict]:
     return products
 
 
-async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: dict) -> dict:
-    detail_url = product.get("detail_url")
+async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: Product) -> Product:
+    detail_url = product.detail_url
     if not detail_url:
         return product
 
@@ -201,9 +271,9 @@ async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: dict) ->
     if not discount_price and original_price:
         discount_price = original_price
 
-    product["original_price"] = original_price
-    product["discount_price"] = discount_price
-    product["discount_rate"] = compute_discount_rate(original_price, discount_price)
+    product.original_price = original_price
+    product.discount_price = discount_price
+    product.discount_rate = compute_discount_rate(original_price, discount_price)
     return product
 
 
@@ -212,74 +282,95 @@ async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: dict) ->
 # ============================================================================
 
 
-async def crawl() -> list[dict]:
-    """Main crawling function for kleineskraftwerk."""
-    async with AsyncWebCrawler(concurrency=2) as crawler:
-        tasks = [fetch_products(crawler, url) for url in URLS]
-        results = await asyncio.gather(*tasks)
-
-        all_items: list[dict] = []
-        for url, items in zip(URLS, results):
-            for item in items:
-                item["source_url"] = url
-                all_items.append(item)
-
-        if all_items:
-            print(f"\n🔄 正在获取 {len(all_items)} 个产品的详情页 ...")
-            enriched_items = await asyncio.gather(*[
-                enrich_product_with_detail(crawler, item) for item in all_items
-            ])
-        else:
-            enriched_items = []
-
-    total = 0
-    all_products: list[dict] = []
-    grouped: dict[str, list[dict]] = {url: [] for url in URLS}
-    for item in enriched_items:
-        source = item.get("source_url", "")
-        grouped.setdefault(source, []).append(item)
-
-    for url in URLS:
-        items = grouped.get(url, [])
-        if not items:
-            continue
-        print(f"\n📦 来自 {url} 的产品：")
-        for item in items:
-            total += 1
-            src = item.get("source_url", url)
-            print(
-                f"- {item['title']} | 原价: {item['original_price']} | "
-                f"优惠价: {item['discount_price']} | 折扣: {item['discount_rate']} | {item['detail_url']}"
-            )
-            all_products.append({
-                "source_url": src,
-                "title": item.get("title", ""),
-                "detail_url": item.get("detail_url", ""),
-                "original_price": item.get("original_price", ""),
-                "discount_price": item.get("discount_price", ""),
-                "discount_rate": item.get("discount_rate", ""),
-            })
-
-    if all_products:
+def open_output_csv() -> io.TextIOWrapper:
+    """Open OUTPUT_PATH for CSV writing, starting with a UTF-8 BOM for Excel."""
+    raw = OUTPUT_PATH.open("wb", buffering=CSV_BUFFER_SIZE)
+    raw.write(codecs.BOM_UTF8)
+    return io.TextIOWrapper(raw, encoding="utf-8", newline="")
+
+
+async def run(crawler: AsyncWebCrawler) -> tuple[int, int]:
+    """Crawl kleineskraftwerk with an externally managed crawler; returns (products, pages)."""
+    sem = asyncio.Semaphore(DETAIL_CONCURRENCY)
+
+    async def enrich_bounded(crawler: AsyncWebCrawler, group: int, item: Product) -> tuple[int, Product]:
+        async with sem:
+            return group, await enrich_product_with_detail(crawler, item)
+
+    tasks = [fetch_products(crawler, url) for url in URLS]
+    results = await asyncio.gather(*tasks)
+
+    # Detail fetches still outstanding per listing page. A page is printed as
+    # soon as it and every page before it are done, so the console output
+    # keeps URL order while later detail pages are still in flight.
+    pending = [len(items) for items in results]
+    total = sum(pending)
+    next_group = 0
+
+    def print_ready_groups() -> None:
+        nonlocal next_group
+        while next_group < len(URLS) and pending[next_group] == 0:
+            items = results[next_group]
+            if items:
+                # Each group is written in one go instead of one print per product
+                lines = [f"\n📦 来自 {URLS[next_group]} 的产品："]
+                lines.extend(
+                    f"- {p.title} | 原价: {p.original_price} | "
+                    f"优惠价: {p.discount_price} | 折扣: {p.discount_rate} | {p.detail_url}"
+                    for p in items
+                )
+                sys.stdout.write("\n".join(lines) + "\n")
+            # Printed groups are not needed any more
+            results[next_group] = []
+            next_group += 1
+
+    if total:
+        print(f"\n🔄 正在获取 {total} 个产品的详情页 ...")
         OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-        fieldnames = [
-            "source_url",
-            "title",
-            "detail_url",
-            "original_price",
-            "discount_price",
-            "discount_rate",
-        ]
-        with OUTPUT_PATH.open("w", newline="", encoding="utf-8-sig") as fh:
-            writer = csv.DictWriter(fh, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(all_products)
-        print(f"\n💾 已保存 {len(all_products)} 条记录到 {OUTPUT_PATH}")
+        # Write each row as soon as its detail page is parsed
+        with open_output_csv() as fh:
+            writer = csv.writer(fh)
+            writer.writerow(FIELDS)
+            tasks = [
+                asyncio.create_task(enrich_bounded(crawler, group, item))
+                for group, items in enumerate(results)
+                for item in items
+            ]
+            try:
+                for fut in asyncio.as_completed(tasks):
+                    group, p = await fut
+                    writer.writerow((
+                        p.source_url,
+                        p.title,
+                        p.detail_url,
+                        p.original_price,
+                        p.discount_price,
+                        p.discount_rate,
+                    ))
+                    pending[group] -= 1
+                    print_ready_groups()
+            finally:
+                # If a detail task failed, stop the rest before the CSV is closed
+                for task in tasks:
+                    if not task.done():
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    if total:
+        print(f"\n💾 已保存 {total} 条记录到 {OUTPUT_PATH}")
     else:
         print("\n⚠️ 无产品数据可保存。")
 
     print(f"\n✅ 完成。共提取 {total} 个产品，覆盖 {len(URLS)} 个页面。")
-    return all_products
+    return total, len(URLS)
+
+
+async def crawl(crawler: AsyncWebCrawler | None = None) -> tuple[int, int]:
+    """Main crawling function for kleineskraftwerk; opens its own crawler unless one is given."""
+    if crawler is not None:
+        return await run(crawler)
+    async with AsyncWebCrawler(concurrency=2) as crawler:
+        return await run(crawler)
 
 
 async def main():
@@ -291,8 +382,6 @@ async def main():
 
 
 if __name__ == "__main__":
-    import sys
-
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
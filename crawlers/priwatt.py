@@ -2,14 +2,20 @@
 Crawler for priwatt.de - Balcony power plant products.
 """
 import asyncio
+import codecs
 import csv
+import io
+import os
 import re
-from decimal import Decimal, InvalidOperation
+import sys
+from dataclasses import dataclass
 from pathlib import Path
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 
-from bs4 import BeautifulSoup
 from crawl4ai import AsyncWebCrawler
+from lxml import etree
+from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
 
 # Configuration
 URLS = [
@@ -19,6 +25,11 @@ URLS = [
     "https://priwatt.de/balkonkraftwerk-speicher/",
 ]
 
+# Maximum number of detail pages fetched at the same time
+DETAIL_CONCURRENCY = max(1, int(os.environ.get("ASH_SPIDER_DETAIL_CONCURRENCY", "8")))
+# Maximum number of requests (listing and detail) in flight against one host
+HOST_CONCURRENCY = max(1, int(os.environ.get("ASH_SPIDER_HOST_CONCURRENCY", "8")))
+
 HEADERS = {
     "User-Agent": (
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
@@ -31,14 +42,52 @@ HEADERS = {
 # Set output path to data folder (parent directory)
 OUTPUT_DIR = Path(__file__).resolve().parent.parent / "data"
 OUTPUT_PATH = OUTPUT_DIR / "priwatt.csv"
+# Write buffer for the output CSV; rows are flushed in large blocks
+CSV_BUFFER_SIZE = 1 << 20
+# CSV columns, in output order
+FIELDS = (
+    "source_url",
+    "title",
+    "detail_url",
+    "original_price",
+    "discount_price",
+    "discount_rate",
+)
+
+# Precompiled patterns
+_NON_NUMERIC_RE = re.compile(r"[^\d.,]")
+
+# Shared HTML parser, reused for every page parsed in this process
+_HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8", remove_blank_text=True, recover=True)
+
+# Precompiled selectors (compiled to XPath once at import)
+_PRODUCT_ANCHORS = CSSSelector("a.block[href]", translator="html")
+_PRODUCT_TITLE = CSSSelector("h4.font-bold", translator="html")
+_DISCOUNT_PRICE = CSSSelector("span[data-test='toc-product-price']", translator="html")
+_ORIGINAL_PRICES = (
+    CSSSelector("div.mt-xs.flex.items-baseline h6.line-through", translator="html"),
+    CSSSelector("h6.line-through", translator="html"),
+)
+
+
+@dataclass(slots=True)
+class Product:
+    """One product row; fields are in FIELDS order."""
+
+    source_url: str
+    title: str
+    detail_url: str
+    original_price: str = ""
+    discount_price: str = ""
+    discount_rate: str = ""
 
 
 def clean_price_text(price: str) -> str:
     if not price:
         return ""
-    price = re.sub(r"^\s*(ab|Ab|AB)\s*", "", price)
-    price = price.replace("€", "").replace("\u00a0", " ").strip()
-    numeric_part = re.sub(r"[^\d.,]", "", price)
+    # Dropping every non-numeric character also removes any "ab" prefix,
+    # currency sign and (non-breaking) whitespace.
+    numeric_part = _NON_NUMERIC_RE.sub("", price)
     if not numeric_part:
         return ""
 
@@ -48,9 +97,8 @@ def clean_price_text(price: str) -> str:
         normalized = numeric_part.replace(".", "")
 
     try:
-        value = Decimal(normalized)
-        return f"{value.quantize(Decimal('0.01'))}"
-    except InvalidOperation:
+        return f"{float(normalized):.2f}"
+    except ValueError:
         return normalized
 
 
@@ -72,27 +120,43 @@ def compute_discount_rate(original_price: str, discount_price: str) -> str:
     return f"{rate:.2f}%"
 
 
-def parse_products(html: str, base_url: str) -> list[dict]:
+def parse_html(html: str):
+    """Parse raw HTML into an lxml element tree; empty or unparseable pages yield an empty <html>."""
+    if not html or html.isspace():
+        return lxml_html.Element("html")
+    try:
+        try:
+            return lxml_html.fromstring(html, parser=_HTML_PARSER)
+        except ValueError:
+            # lxml refuses str input that carries an XML encoding declaration;
+            # the shared parser decodes UTF-8, so hand it the encoded bytes.
+            return lxml_html.fromstring(html.encode("utf-8"), parser=_HTML_PARSER)
+    except etree.ParserError:
+        # e.g. comment-only documents
+        return lxml_html.Element("html")
+
+
+def stripped_text(el) -> str:
+    """Return the element's text nodes stripped and concatenated, like get_text(strip=True)."""
+    return "".join(t.strip() for t in el.itertext())
+
+
+def parse_products(html: str, base_url: str) -> list[Product]:
     if not html:
         return []
 
-    soup = BeautifulSoup(html, "lxml")
-    products: list[dict] = []
-    for anchor in soup.select("a.block[href]"):
-        title_el = anchor.select_one("h4.font-bold")
-        if not title_el:
+    doc = parse_html(html)
+    products: list[Product] = []
+    for anchor in _PRODUCT_ANCHORS(doc):
+        title_els = _PRODUCT_TITLE(anchor)
+        if not title_els:
             continue
 
-        title = title_el.get_text(strip=True)
+        title = stripped_text(title_els[0])
         href = anchor.get("href") or ""
-        detail_url = urljoin(base_url, href)
+        detail_url = href if href.startswith(("http://", "https://")) else urljoin(base_url, href)
 
-        products.append({
-            "title": title,
-            "detail_url": detail_url,
-            "original_price": "",
-            "discount_price": "",
-        })
+        products.append(Product(base_url, title, detail_url))
 
     return products
 
@@ -101,18 +165,19 @@ def extract_prices_from_detail(html: str) -> tuple[str, str]:
     if not html:
         return "", ""
 
-    soup = BeautifulSoup(html, "lxml")
+    doc = parse_html(html)
 
     discount_price = ""
-    discount_el = soup.select_one("span[data-test='toc-product-price']")
-    if discount_el:
-        discount_price = clean_price_text(discount_el.get_text(strip=True))
+    discount_els = _DISCOUNT_PRICE(doc)
+    if discount_els:
+        discount_price = clean_price_text(stripped_text(discount_els[0]))
 
     original_price = ""
-    original_el = (soup.select_one("div.mt-xs.flex.items-baseline h6.line-through")
-                   or soup.select_one("h6.line-through"))
-    if original_el:
-        original_price = clean_price_text(original_el.get_text(strip=True))
+    for selector in _ORIGINAL_PRICES:
+        original_els = selector(doc)
+        if original_els:
+            original_price = clean_price_text(stripped_text(original_els[0]))
+            break
 
     if not original_price and discount_price:
         original_price = discount_price
@@ -122,7 +187,7 @@ def extract_prices_from_detail(html: str) -> tuple[str, str]:
     return original_price, discount_price
 
 
-async def fetch_products(crawler: AsyncWebCrawler, url: str) -> list[dict]:
+async def fetch_products(crawler: AsyncWebCrawler, url: str) -> list[Product]:
     print(f"🔍 正在爬取 {url} ...")
     try:
         res = await crawler.arun(
@@ -145,8 +210,8 @@ async def fetch_products(crawler: AsyncWebCrawler, url: str) -> list[dict]:
     return products
 
 
-async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: dict) -> dict:
-    detail_url = product.get("detail_url")
+async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: Product) -> Product:
+    detail_url = product.detail_url
     if not detail_url:
         return product
 
@@ -167,9 +232,9 @@ async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: dict) ->
         return product
 
     original_price, discount_price = extract_prices_from_detail(res.html)
-    product["original_price"] = original_price
-    product["discount_price"] = discount_price
-    product["discount_rate"] = compute_discount_rate(original_price, discount_price)
+    product.original_price = original_price
+    product.discount_price = discount_price
+    product.discount_rate = compute_discount_rate(original_price, discount_price)
     return product
 
 
@@ -178,142 +243,124 @@ async def enrich_product_with_detail(crawler: AsyncWebCrawler, product: dict) ->
 # ============================================================================
 
 
-async def crawl() -> list[dict]:
-    """Main crawling function for priwatt."""
-    async with AsyncWebCrawler(concurrency=2) as crawler:
-        tasks = [fetch_products(crawler, url) for url in URLS]
-        results = await asyncio.gather(*tasks)
-
-        all_items: list[dict] = []
-        for url, items in zip(URLS, results):
-            for item in items:
-                item["source_url"] = url
-                all_items.append(item)
-
-        if all_items:
-            print(f"\n🔄 正在获取 {len(all_items)} 个产品的详情页 ...")
-            enriched_items = await asyncio.gather(*[
-                enrich_product_with_detail(crawler, item) for item in all_items
-            ])
-        else:
-            enriched_items = []
+def open_output_csv() -> io.TextIOWrapper:
+    """Open OUTPUT_PATH for CSV writing, starting with a UTF-8 BOM for Excel."""
+    raw = OUTPUT_PATH.open("wb", buffering=CSV_BUFFER_SIZE)
+    raw.write(codecs.BOM_UTF8)
+    return io.TextIOWrapper(raw, encoding="utf-8", newline="")
 
-    total = 0
-    all_products: list[dict] = []
-    grouped: dict[str, list[dict]] = {url: [] for url in URLS}
-    for item in enriched_items:
-        source = item.get("source_url", "")
-        grouped.setdefault(source, []).append(item)
 
+def _print_summary(lines_by_url: dict[str, list[str]]) -> int:
+    """Print the crawled products grouped by listing page; returns the product count."""
+    total = 0
     for url in URLS:
-        items = grouped.get(url, [])
-        if not items:
+        lines = lines_by_url[url]
+        if not lines:
             continue
-        print(f"\n📦 来自 {url} 的产品：")
-        for item in items:
-            total += 1
-            print(
-                f"- {item['title']} | 原价: {item.get('original_price', '')} | "
-                f"优惠价: {item.get('discount_price', '')} | 折扣: {item.get('discount_rate', '')} | {item['detail_url']}"
-            )
-            all_products.append({
-                "source_url": item.get("source_url", url),
-                "title": item.get("title", ""),
-                "detail_url": item.get("detail_url", ""),
-                "original_price": item.get("original_price", ""),
-                "discount_price": item.get("discount_price", ""),
-                "discount_rate": item.get("discount_rate", ""),
-            })
-
-    if all_products:
-        OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-        fieldnames = [
-            "source_url",
-            "title",
-            "detail_url",
-            "original_price",
-            "discount_price",
-            "discount_rate",
-        ]
-        with OUTPUT_PATH.open("w", newline="", encoding="utf-8-sig") as fh:
-            writer = csv.DictWriter(fh, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(all_products)
-        print(f"\n💾 已保存 {len(all_products)} 条记录到 {OUTPUT_PATH}")
+        total += len(lines)
+        # One write per group instead of one per product
+        sys.stdout.write(f"\n📦 来自 {url} 的产品：\n" + "\n".join(lines) + "\n")
+
+    if total:
+        print(f"\n💾 已保存 {total} 条记录到 {OUTPUT_PATH}")
     else:
         print("\n⚠️ 无产品数据可保存。")
 
     print(f"\n✅ 完成。共提取 {total} 个产品，覆盖 {len(URLS)} 个页面。")
-    return all_products
-
-
-async def main():
-    """Main function."""
-    async with AsyncWebCrawler(concurrency=2) as crawler:
-        tasks = [fetch_products(crawler, url) for url in URLS]
-        results = await asyncio.gather(*tasks)
-
-        all_items: list[dict] = []
-        for url, items in zip(URLS, results):
-            for item in items:
-                item["source_url"] = url
-                all_items.append(item)
-
-        if all_items:
-            print(f"\n🔄 正在获取 {len(all_items)} 个产品的详情页 ...")
-            enriched_items = await asyncio.gather(*[
-                enrich_product_with_detail(crawler, item) for item in all_items
-            ])
-        else:
-            enriched_items = []
-
-    total = 0
-    all_products: list[dict] = []
-    grouped: dict[str, list[dict]] = {url: [] for url in URLS}
-    for item in enriched_items:
-        source = item.get("source_url", "")
-        grouped.setdefault(source, []).append(item)
-
-    for url in URLS:
-        items = grouped.get(url, [])
-        if not items:
-            continue
-        print(f"\n📦 来自 {url} 的产品：")
-        for item in items:
-            total += 1
-            print(
-                f"- {item['title']} | original: {item.get('original_price', '')} | "
-                f"discount: {item.get('discount_price', '')} | rate: {item.get('discount_rate', '')} | {item['detail_url']}"
+    return total
+
+
+async def run(crawler: AsyncWebCrawler) -> tuple[int, int]:
+    """Crawl priwatt with an externally managed crawler; returns (products, pages)."""
+    # Listing pages feed a bounded queue drained by DETAIL_CONCURRENCY
+    # consumers, so detail fetches start as soon as the first listing is in.
+    queue: asyncio.Queue = asyncio.Queue(maxsize=DETAIL_CONCURRENCY)
+    # Only each product's summary line is kept once its CSV row is written.
+    # produce() sizes each page's list and the line goes into the product's
+    # listing slot, so the summary keeps listing order.
+    lines_by_url: dict[str, list[str]] = {url: [] for url in URLS}
+    # The CSV is opened on the first row, so a run that finds nothing
+    # leaves the previous output untouched.
+    fh = None
+    writer = None
+
+    def write_row(p: Product) -> None:
+        nonlocal fh, writer
+        if writer is None:
+            OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+            fh = open_output_csv()
+            writer = csv.writer(fh)
+            writer.writerow(FIELDS)
+        writer.writerow((
+            p.source_url,
+            p.title,
+            p.detail_url,
+            p.original_price,
+            p.discount_price,
+            p.discount_rate,
+        ))
+
+    host_limits: dict[str, asyncio.Semaphore] = {}
+
+    def host_limit(url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in host_limits:
+            host_limits[host] = asyncio.Semaphore(HOST_CONCURRENCY)
+        return host_limits[host]
+
+    async def produce(url: str) -> int:
+        async with host_limit(url):
+            items = await fetch_products(crawler, url)
+        lines_by_url[url] = [""] * len(items)
+        for index, item in enumerate(items):
+            await queue.put((index, item))
+        return len(items)
+
+    async def produce_all() -> None:
+        counts = await asyncio.gather(*[produce(url) for url in URLS])
+        if sum(counts):
+            print(f"\n🔄 列表页已全部解析，共 {sum(counts)} 个产品进入详情页队列 ...")
+        for _ in range(DETAIL_CONCURRENCY):
+            await queue.put(None)
+
+    async def consume() -> None:
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            index, item = entry
+            async with host_limit(item.detail_url):
+                item = await enrich_product_with_detail(crawler, item)
+            write_row(item)
+            lines_by_url[item.source_url][index] = (
+                f"- {item.title} | 原价: {item.original_price} | "
+                f"优惠价: {item.discount_price} | 折扣: {item.discount_rate} | {item.detail_url}"
             )
-            all_products.append({
-                "source_url": item.get("source_url", url),
-                "title": item.get("title", ""),
-                "detail_url": item.get("detail_url", ""),
-                "original_price": item.get("original_price", ""),
-                "discount_price": item.get("discount_price", ""),
-                "discount_rate": item.get("discount_rate", ""),
-            })
-
-    if all_products:
-        OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-        fieldnames = [
-            "source_url",
-            "title",
-            "detail_url",
-            "original_price",
-            "discount_price",
-            "discount_rate",
-        ]
-        with OUTPUT_PATH.open("w", newline="", encoding="utf-8-sig") as fh:
-            writer = csv.DictWriter(fh, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(all_products)
-        print(f"\n💾 已保存 {len(all_products)} 条记录到 {OUTPUT_PATH}")
-    else:
-        print("\n⚠️ 无产品数据可保存。")
 
-    print(f"\n✅ 完成。共提取 {total} 个产品，覆盖 {len(URLS)} 个页面。")
-    return all_products
+    tasks = [asyncio.create_task(produce_all())]
+    tasks += [asyncio.create_task(consume()) for _ in range(DETAIL_CONCURRENCY)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # If any task failed (or run() was cancelled), stop the rest before the
+        # CSV is closed and the caller shuts the crawler down.
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if fh is not None:
+            fh.close()
+
+    total = _print_summary(lines_by_url)
+    return total, len(URLS)
+
+
+async def crawl(crawler: AsyncWebCrawler | None = None) -> tuple[int, int]:
+    """Main crawling function for priwatt; opens its own crawler unless one is given."""
+    if crawler is not None:
+        return await run(crawler)
+    async with AsyncWebCrawler(concurrency=2) as crawler:
+        return await run(crawler)
 
 
 async def main():
@@ -325,7 +372,6 @@ async def main():
 
 
 if __name__ == "__main__":
-    import sys
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -6,10 +6,19 @@ Supports running individual crawlers or all crawlers together via an interactive
 """
 
 import asyncio
+import importlib
 import sys
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, Dict, Any, List
 
+from crawl4ai import AsyncWebCrawler
+
+try:
+    import uvloop
+except ImportError:  # Optional speedup; not available on Windows
+    uvloop = None
+
 
 # --- Crawler Configuration ---
 # Maps a user-friendly key to crawler details.
@@ -51,7 +60,42 @@ def print_menu() -> None:
     print("  q. 退出\n")
 
 
-def get_user_choice() -> Optional[List[str]]:
+async def _ainput(prompt: str) -> str:
+    """
+    Reads a line from stdin without blocking the event loop.
+
+    On POSIX the loop watches stdin with add_reader, so no thread is left
+    blocked in input() when Ctrl+C cancels the wait. Event loops without
+    add_reader (Windows) or a stdin that cannot be watched (a regular file)
+    fall back to reading in the default executor.
+    """
+    loop = asyncio.get_running_loop()
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+
+    future = loop.create_future()
+
+    def on_readable() -> None:
+        if not future.done():
+            future.set_result(sys.stdin.readline())
+
+    try:
+        fd = sys.stdin.fileno()
+        loop.add_reader(fd, on_readable)
+    except (NotImplementedError, OSError, ValueError):
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+    else:
+        try:
+            line = await future
+        finally:
+            loop.remove_reader(fd)
+
+    if not line:
+        raise EOFError("EOF when reading a line")
+    return line.rstrip("\n")
+
+
+async def get_user_choice() -> Optional[List[str]]:
     """
     Prompts the user to select a crawler and returns their choice.
 
@@ -60,7 +104,7 @@ def get_user_choice() -> Optional[List[str]]:
     """
     while True:
         print_menu()
-        choice = input("请输入选择（例如 1、a、q）：").strip().lower()
+        choice = (await _ainput("请输入选择（例如 1、a、q）：")).strip().lower()
 
         if choice == "q":
             print("\n再见！")
@@ -77,12 +121,19 @@ def get_user_choice() -> Optional[List[str]]:
 
 # --- Crawler Execution Logic ---
 
-async def run_crawler(crawler_key: str) -> bool:
+@lru_cache(maxsize=None)
+def load_crawler_module(module_name: str):
+    """Imports a crawler module once and returns the cached module object."""
+    return importlib.import_module(module_name)
+
+
+async def run_crawler(crawler_key: str, crawler: Optional[AsyncWebCrawler] = None) -> bool:
     """
     Dynamically imports and runs a single crawler's 'crawl' function.
 
     Args:
         crawler_key: The key corresponding to the crawler in the CRAWLERS dict.
+        crawler: A shared AsyncWebCrawler to run on; the crawler opens its own if omitted.
 
     Returns:
         True if the crawler ran successfully, False otherwise.
@@ -99,14 +150,14 @@ async def run_crawler(crawler_key: str) -> bool:
 
     try:
         # Dynamically import the specified crawler module
-        module = __import__(module_name, fromlist=[crawler_name])
+        module = load_crawler_module(module_name)
 
         if not hasattr(module, "crawl"):
             print(f"[错误] 模块 '{module_name}' 未包含 'crawl' 函数。")
             return False
 
         # Execute the crawl function
-        await module.crawl()
+        await module.crawl(crawler)
         print(f"[成功] 爬虫 '{crawler_name}' 已完成。")
         return True
 
@@ -122,7 +173,7 @@ async def run_crawler(crawler_key: str) -> bool:
 
 async def run_selected_crawlers(crawler_keys: List[str]) -> int:
     """
-    Runs a list of selected crawlers and prints a summary.
+    Runs a list of selected crawlers concurrently and prints a summary.
 
     Args:
         crawler_keys: A list of keys for the crawlers to be executed.
@@ -130,10 +181,23 @@ async def run_selected_crawlers(crawler_keys: List[str]) -> int:
     Returns:
         An exit code (0 for success, 1 if any crawler failed).
     """
-    results = []
-    for key in crawler_keys:
-        success = await run_crawler(key)
-        results.append((CRAWLERS[key]["name"], success))
+    # Crawlers are independent and network-bound, so run them concurrently
+    # on one shared crawler instead of starting a browser per site
+    outcomes: List[Any] = [False] * len(crawler_keys)
+    try:
+        async with AsyncWebCrawler(concurrency=len(crawler_keys) * 2) as shared:
+            outcomes = await asyncio.gather(
+                *[run_crawler(key, shared) for key in crawler_keys], return_exceptions=True
+            )
+    except Exception as e:
+        # e.g. the browser failed to start; crawlers that never ran count as failed
+        print(f"[错误] 共享爬虫启动或关闭时发生错误：{e}")
+        import traceback
+        traceback.print_exc()
+    results = [
+        (CRAWLERS[key]["name"], outcome is True)
+        for key, outcome in zip(crawler_keys, outcomes)
+    ]
 
     # Print a final summary of all operations
     print_header("执行摘要")
@@ -150,24 +214,32 @@ async def run_selected_crawlers(crawler_keys: List[str]) -> int:
 
 # --- Main Application Entry Point ---
 
-def main() -> int:
+async def main_async() -> int:
     """
-    Main entry point for the Ash Spider application.
-    Handles user interaction and orchestrates the crawling process.
+    Runs the interactive menu and the selected crawlers on the current event loop.
     """
-    # Add the 'crawlers' directory to the Python path to allow for dynamic imports
-    sys.path.insert(0, str(Path(__file__).resolve().parent))
-
     print_header("欢迎使用 Ash Spider - 网络爬虫套件")
 
     # Get the user's choice from the interactive menu
-    selected_keys = get_user_choice()
+    selected_keys = await get_user_choice()
     if not selected_keys:
         return 0  # User chose to quit
 
-    # Run the selected crawlers
+    return await run_selected_crawlers(selected_keys)
+
+
+def main() -> int:
+    """
+    Main entry point for the Ash Spider application.
+    Handles user interaction and orchestrates the crawling process.
+    """
+    # Add the 'crawlers' directory to the Python path to allow for dynamic imports
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+    # Run the menu and crawlers on uvloop's event loop when it is installed
+    run = uvloop.run if uvloop is not None else asyncio.run
     try:
-        return asyncio.run(run_selected_crawlers(selected_keys))
+        return run(main_async())
     except KeyboardInterrupt:
         print("\n\n[中断] 操作被用户取消。")
         return 130